@@ -1,11 +1,17 @@
 # run_rum.py
 import os
+import io
 import json
 import re
 import time
+import threading
+import ijson
+import orjson
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timezone, timedelta
-import sys
 
 # ----------------- Config from env (GitHub secrets) -----------------
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -15,33 +21,70 @@ ZOHO_TOKEN_URL     = os.getenv("ZOHO_TOKEN_URL", "https://accounts.zoho.com/oaut
 ZOHO_REFRESH_TOKEN = os.getenv("ZOHO_REFRESH_TOKEN")
 ZOHO_CLIENT_ID     = os.getenv("ZOHO_CLIENT_ID")
 ZOHO_CLIENT_SECRET = os.getenv("ZOHO_CLIENT_SECRET")
+ZOHO_TOKEN_CACHE   = os.getenv("ZOHO_TOKEN_CACHE", "/tmp/zoho_token.json")
+
+# Set RUM_DEBUG to dump each raw Site24x7 response to /tmp/rum_debug_<id>.json
+RUM_DEBUG          = bool(os.getenv("RUM_DEBUG"))
 
 # RUM monitors mapping (string JSON in secret optional). Defaults to your 3 monitors.
-RUM_MONITORS = json.loads(os.getenv("RUM_MONITORS", json.dumps({
+_rum_monitors_env = os.getenv("RUM_MONITORS")
+RUM_MONITORS = json.loads(_rum_monitors_env) if _rum_monitors_env else {
     "AWC7": "509934000004443003",
     "IG7" : "509934000004441003",
     "QM7" : "509934000004443045"
-})))
+}
+
+# One worker per monitor (capped) so fetches overlap without manual tuning
+MAX_WORKERS = max(1, min(len(RUM_MONITORS), 16))
+
+# ----------------- HTTP session -----------------
+# One pooled session for Zoho, Site24x7 and Telegram so every call after the
+# first reuses a kept-alive TLS connection instead of a fresh handshake.
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "site24x7-rum-alerts/1.0"
+# Retries (incl. POST) happen inside urllib3 on the pooled connection, with
+# backoff and honouring Telegram's Retry-After on 429.
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(8, MAX_WORKERS),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST", "GET"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
+# ----------------- Path cleaning patterns -----------------
+_RE_EXCLUDE = re.compile(r"/syn33/[^/]+/slots/games/[^/]+")
+# Prefix/infix/suffix noise stripped in a single pass
+_RE_STRIP   = re.compile(r"^/asia-ig7/|^/syn33/\*/|/games/\*/|/\*/index\.html$")
 
 # ----------------- Helpers -----------------
+# Inside MarkdownV2 `code` only ` and \ are special: swap backticks, escape backslashes.
+_CODE_TABLE = str.maketrans({"`": "'", "\\": "\\\\"})
+
 def _sanitize_backticks(text: str) -> str:
-    """Replace backticks so we can safely wrap the whole line inside single backticks."""
+    """Make text safe to wrap inside single backticks (one translate pass)."""
     if text is None:
         return ""
-    return str(text).replace("`", "'")
+    s = str(text)
+    # most game names and lines contain neither char: skip the copy
+    if "`" in s or "\\" in s:
+        return s.translate(_CODE_TABLE)
+    return s
 
 def clean_path(path: str) -> str:
     """Return cleaned path or empty string to exclude."""
     if not isinstance(path, str):
         return ""
-    if re.search(r"/syn33/[^/]+/slots/games/[^/]+", path):
+    if _RE_EXCLUDE.search(path):
         return ""
-    path = re.sub(r"^/asia-ig7/", "", path)
-    path = re.sub(r"^/syn33/\*/", "", path)
-    path = re.sub(r"/games/\*/", "", path)
-    path = re.sub(r"/\*/index\.html$", "", path)
-    path = re.sub(r"/+", "/", path).strip("/")
-    return path
+    path = _RE_STRIP.sub("", path)
+    # collapse repeated slashes and trim leading/trailing ones
+    return "/".join(filter(None, path.split("/")))
 
 # ----------------- Zoho token & Site24x7 fetch -----------------
 def refresh_access_token():
@@ -53,52 +96,143 @@ def refresh_access_token():
         "client_secret": ZOHO_CLIENT_SECRET,
         "grant_type": "refresh_token"
     }
-    r = requests.post(ZOHO_TOKEN_URL, data=params, timeout=15)
+    r = SESSION.post(ZOHO_TOKEN_URL, data=params, timeout=15)
     r.raise_for_status()
-    return r.json()["access_token"]
+    j = orjson.loads(r.content)
+    token = j["access_token"]
+    _save_cached_token(token, j.get("expires_in", 3600))
+    return token
+
+def _load_cached_token():
+    """Return the cached access token if it has not expired yet, else None."""
+    try:
+        with open(ZOHO_TOKEN_CACHE, "rb") as fh:
+            cached = orjson.loads(fh.read())
+        if time.time() < cached["expiry"]:
+            return cached["access_token"]
+    except Exception:
+        pass
+    return None
+
+def _save_cached_token(token, expires_in):
+    """Write the token (owner-only, 60s safety margin); os.replace keeps the write atomic."""
+    try:
+        tmp = f"{ZOHO_TOKEN_CACHE}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(orjson.dumps({"access_token": token, "expiry": time.time() + int(expires_in) - 60}))
+        os.replace(tmp, ZOHO_TOKEN_CACHE)
+    except Exception as e:
+        print("Could not cache Zoho token:", e)
+
+def _invalidate_cached_token():
+    try:
+        os.remove(ZOHO_TOKEN_CACHE)
+    except FileNotFoundError:
+        pass
+
+_TOKEN_LOCK = threading.Lock()
+
+def get_access_token(stale_token=None):
+    """
+    Return a Zoho access token, reusing the cached one while it is valid.
+    Pass the token Site24x7 just rejected as `stale_token` to force a refresh;
+    concurrent callers with the same stale token share a single refresh.
+    """
+    with _TOKEN_LOCK:
+        cached = _load_cached_token()
+        if cached and cached != stale_token:
+            return cached
+        if stale_token:
+            _invalidate_cached_token()
+        return refresh_access_token()
 
 def fetch_rum_data(rum_id, token):
+    """
+    Request a monitor's transaction list and return an iterator over its rows.
+    HTTP errors raise here; the body is parsed as the caller iterates, so only
+    the rows the caller keeps stay in memory.
+    """
     url = f"https://www.site24x7.com/api/rum/web/view/{rum_id}/wt/list/avgRT/H"
     headers = {"Authorization": f"Zoho-oauthtoken {token}"}
-    r = requests.get(url, headers=headers, timeout=25)
-    r.raise_for_status()
-    j = r.json()
-
+    r = SESSION.get(url, headers=headers, stream=True, timeout=25)
     try:
-        fname = f"/tmp/rum_debug_{rum_id}.json"
-        with open(fname, "w", encoding="utf-8") as fh:
-            json.dump(j, fh, indent=2)
+        r.raise_for_status()
     except Exception:
-        pass
+        r.close()
+        raise
+
+    if RUM_DEBUG:
+        body = r.content
+        try:
+            fname = f"/tmp/rum_debug_{rum_id}.json"
+            with open(fname, "wb") as fh:
+                fh.write(body)
+        except Exception:
+            pass
+        return _iter_rum_items(io.BytesIO(body))
+
+    r.raw.decode_content = True
+    return _iter_response_rows(r)
 
-    if "data" not in j:
-        return []
-    data_field = j["data"]
-    if isinstance(data_field, list):
-        return data_field
-    if isinstance(data_field, dict):
-        if "list" in data_field and isinstance(data_field["list"], list):
-            return data_field["list"]
-        for v in data_field.values():
-            if isinstance(v, list):
-                return v
-    return []
+def _iter_response_rows(r):
+    with r:
+        yield from _iter_rum_items(r.raw)
+
+def _iter_rum_items(fp):
+    """
+    Stream rows out of a Site24x7 response: "data" itself if it is a list,
+    else "data.list", else the first other list directly under "data".
+    """
+    events = ijson.parse(fp, use_float=True)
+    fallback = None
+    for prefix, event, _ in events:
+        if event != "start_array":
+            continue
+        if prefix in ("data", "data.list"):
+            yield from _iter_array(events, prefix)
+            return
+        if fallback is None and prefix.startswith("data.") and prefix.count(".") == 1:
+            # another list came first; hold it in case "list" never shows up
+            fallback = list(_iter_array(events, prefix))
+    yield from fallback or ()
+
+def _iter_array(events, prefix):
+    """Yield the elements of the array at `prefix` whose start_array was just consumed."""
+    builder = None
+    depth = 0
+    for p, event, value in events:
+        if builder is None:
+            if p == prefix and event == "end_array":
+                return
+            if event not in ("start_map", "start_array"):
+                yield value
+                continue
+            builder = ijson.ObjectBuilder()
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+            if depth == 0:
+                yield builder.value
+                builder = None
 
 # ----------------- Formatting -----------------
+# Indexed by (avg_s > 6); only rows >= 5s reach the lookup.
+_EMOJI = ("⚠️", "🚨")
+
 def format_monitor_lines(rum_data):
     """
     Build aligned table lines (monospace): Game (left), Avg (right), Emoji.
     Only include rows >= 5 seconds.
     """
     rows = []
+    max_game_len = 0
+    max_avg_len = 0
     for item in rum_data or []:
-        raw_path = item.get("name", "") or ""
-        path = clean_path(raw_path)
-        if not path:
-            continue
-        if path.startswith("prod/") or path.strip() in {"*", ""}:
-            continue
-
+        # Gates run cheapest first so rows that get dropped never reach the regexes.
+        # 1) threshold: one float conversion and a compare
         try:
             avg_ms = float(item.get("average_response_time", 0))
             avg_s = avg_ms / 1000.0
@@ -109,10 +243,27 @@ def format_monitor_lines(rum_data):
         if avg_s < 5.0:
             continue
 
-        emoji = "🚨" if avg_s > 6 else "⚠️"
-        game = _sanitize_backticks(path)
+        # 2) raw prod prefix: a single startswith
+        raw_path = item.get("name", "") or ""
+        if not isinstance(raw_path, str) or raw_path.startswith("/prod/"):
+            continue
+
+        # 3) clean_path: exclude regex plus one substitution pass
+        path = clean_path(raw_path)
+        if not path:
+            continue
+        if path.startswith("prod/") or path.strip() in {"*", ""}:
+            continue
+
+        emoji = _EMOJI[avg_s > 6]
+        game = path  # escaped once, per line, when the message is built
         avg_str = f"{avg_s:.2f} sec"
         rows.append((game, avg_s, avg_str, emoji))
+        # track column widths while building rows (no second pass)
+        if len(game) > max_game_len:
+            max_game_len = len(game)
+        if len(avg_str) > max_avg_len:
+            max_avg_len = len(avg_str)
 
     if not rows:
         return ["No data ≥ 5 sec"]
@@ -121,56 +272,52 @@ def format_monitor_lines(rum_data):
     rows.sort(key=lambda x: x[1], reverse=True)
 
     # dynamic column widths
-    max_game_len = max(len(r[0]) for r in rows)
     game_w = max(20, max_game_len + 2)
-    max_avg_len = max(len(r[2]) for r in rows)
     avg_w = max(8, max_avg_len)
 
     lines = []
-    header = f"{'Game'.ljust(game_w)}{'Avg'.rjust(avg_w)}"
+    header = f"{'Game':<{game_w}}{'Avg':>{avg_w}}"
     lines.append(header)
     lines.append("")  # blank line
 
     for game, _, avg_str, emoji in rows:
-        line = f"{game.ljust(game_w)}{avg_str.rjust(avg_w)}   {emoji}"
+        line = f"{game:<{game_w}}{avg_str:>{avg_w}}   {emoji}"
         lines.append(line)
         lines.append("")
 
     return lines
 
 # ----------------- Telegram sending -----------------
+# Telegram caps messages at 4096 chars; leave headroom for entity markup.
+TELEGRAM_MAX_LEN = 3800
+
+# Built once; each send only adds its text
+_TG_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage" if TELEGRAM_BOT_TOKEN else None
+_TG_BASE = {"chat_id": TELEGRAM_CHAT_ID, "parse_mode": "MarkdownV2"}
+_TG_HEADERS = {"Content-Type": "application/json"}
+
 def send_telegram_message_safe(message_text: str):
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         raise Exception("Telegram credentials missing in environment variables")
 
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": message_text,
-        "parse_mode": "MarkdownV2"
-    }
+    payload = {**_TG_BASE, "text": message_text}
 
-    for attempt in range(3):
-        try:
-            r = requests.post(url, json=payload, timeout=15)
-            if r.status_code == 200:
-                print("Telegram sent (len=%d)" % len(message_text))
-                return True
-            else:
-                print(f"Telegram HTTP {r.status_code}: {r.text}")
-        except Exception as e:
-            print("Telegram send exception:", str(e))
-        time.sleep(2 ** attempt)
-    print("Telegram sending failed after retries.")
+    try:
+        r = SESSION.post(_TG_URL, data=orjson.dumps(payload), headers=_TG_HEADERS, timeout=15)
+    except Exception as e:
+        print("Telegram send exception:", str(e))
+        return False
+    if r.status_code == 200:
+        print("Telegram sent (len=%d)" % len(message_text))
+        return True
+    print(f"Telegram HTTP {r.status_code}: {r.text}")
     return False
 
-def send_monitor_block(monitor_name: str, rum_data):
-    lines = format_monitor_lines(rum_data)
+def build_monitor_block(monitor_name: str, lines):
+    """Return one monitor's table as code-formatted Telegram lines."""
     divider = "-" * 40
 
     msg_lines = []
-    msg_lines.append(f"`📊 Site24x7 RUM Summary`")
-    msg_lines.append("")
     msg_lines.append(f"`[{_sanitize_backticks(monitor_name)}]`")
     msg_lines.append("")
 
@@ -179,11 +326,60 @@ def send_monitor_block(monitor_name: str, rum_data):
         msg_lines.append(f"`{safe_ln}`")
 
     msg_lines.append(f"`{divider}`")
+    return "\n".join(msg_lines)
 
-    message_text = "\n".join(msg_lines)
-    send_telegram_message_safe(message_text)
+def build_error_block(monitor_name: str, error: str):
+    """Return the block shown in place of a monitor's table when it failed."""
+    divider = "-" * 40
+    return f"`[{_sanitize_backticks(monitor_name)}]`\n\n`❌ { _sanitize_backticks(error) }`\n`{divider}`"
+
+def _chunk_blocks(blocks, header: str, limit: int):
+    """
+    Pack blocks under the header into as few messages as fit in `limit` chars.
+    A block that is too long on its own is split on line boundaries.
+    """
+    chunks = []
+    current = header
+    for block in blocks:
+        if len(current) + 1 + len(block) <= limit:
+            current += "\n" + block
+            continue
+        if current != header:
+            chunks.append(current)
+            current = header
+        for ln in block.split("\n"):
+            if len(current) + 1 + len(ln) > limit and current != header:
+                chunks.append(current)
+                current = header
+            current += "\n" + ln
+    chunks.append(current)
+    return chunks
+
+def send_combined(blocks):
+    """Send every monitor block in one Telegram message, chunking only if it is too long."""
+    header = "`📊 Site24x7 RUM Summary`\n"
+    ok = True
+    for chunk in _chunk_blocks(blocks, header, TELEGRAM_MAX_LEN):
+        ok = send_telegram_message_safe(chunk) and ok
+    return ok
 
 # ----------------- Main -----------------
+def _process_monitor(name, rum_id, token):
+    """Fetch one monitor and return (name, lines, error); nothing is sent from here."""
+    print("Processing monitor:", name, rum_id)
+    try:
+        try:
+            rum_data = fetch_rum_data(rum_id, token)
+        except requests.HTTPError as e:
+            # cached token revoked or expired early: refresh once and retry
+            if e.response is None or e.response.status_code != 401:
+                raise
+            rum_data = fetch_rum_data(rum_id, get_access_token(stale_token=token))
+        return name, format_monitor_lines(rum_data), None
+    except Exception as e:
+        print("Error for monitor", name, str(e))
+        return name, None, str(e)
+
 def main():
     # Philippine Time (UTC+8)
     ph_tz = timezone(timedelta(hours=8))
@@ -192,24 +388,49 @@ def main():
     # Only run at exact hour
     if now.minute != 0:
         print(f"Skipping run at {now.strftime('%Y-%m-%d %H:%M:%S')} PH (not top of hour)")
-        sys.exit(0)
+        return
 
     print("Run start:", now.strftime("%Y-%m-%d %H:%M:%S"), "PH")
-    token = refresh_access_token()
-    for name, rum_id in RUM_MONITORS.items():
-        print("Processing monitor:", name, rum_id)
+    try:
+        token = get_access_token()
+    except Exception as e:
+        # no monitor can run without a token: report it on its own and fail the job
+        print("Zoho token refresh failed:", str(e))
         try:
-            rum_data = fetch_rum_data(rum_id, token)
-            send_monitor_block(name, rum_data)
-            time.sleep(1)
-        except Exception as e:
-            print("Error for monitor", name, str(e))
+            send_combined([build_error_block("Zoho", str(e))])
+        except Exception as e2:
+            print("Failed to send error via Telegram:", e2)
+        raise
+
+    # Monitors are independent I/O, so run them side by side: wall time
+    # becomes the slowest monitor rather than the sum of all of them.
+    results = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {
+            ex.submit(_process_monitor, name, rum_id, token): name
+            for name, rum_id in RUM_MONITORS.items()
+        }
+        for f in as_completed(futures):
             try:
-                err_msg = f"`📊 Site24x7 RUM Summary`\n`[{_sanitize_backticks(name)}]`\n\n`❌ { _sanitize_backticks(str(e)) }`"
-                send_telegram_message_safe(err_msg)
-            except Exception as e2:
-                print("Failed to send error via Telegram:", e2)
-            continue
+                name, lines, error = f.result()
+            except Exception as e:
+                name, lines, error = futures[f], None, str(e)
+                print("Unexpected error for monitor", name, error)
+            results[name] = (lines, error)
+
+    # Tables and error notices go out together, in configured monitor order
+    blocks = []
+    for name in RUM_MONITORS:
+        lines, error = results[name]
+        if error is not None:
+            blocks.append(build_error_block(name, error))
+        else:
+            blocks.append(build_monitor_block(name, lines))
+
+    try:
+        send_combined(blocks)
+    except Exception as e:
+        print("Failed to send summary via Telegram:", e)
 
 if __name__ == "__main__":
     main()